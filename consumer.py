@@ -5,7 +5,9 @@ import csv
 import sys
 import io
 import os
-from datetime import datetime
+import collections
+import functools
+from datetime import datetime, timezone
 import osmdiff
 
 # epoch in seconds
@@ -21,24 +23,181 @@ TAGS = os.getenv("TAGS", 0)
 
 max_changeset_id = 0
 
+# CSV output is formatted CSV_CHUNK_ROWS rows at a time and passed to stdout
+# whenever at least CSV_FLUSH_SIZE characters are pending
+CSV_CHUNK_ROWS = 512
+CSV_FLUSH_SIZE = 64 * 1024
 
-def write_csv_stdout(rows, fieldnames):
-    """Write rows (a list of dictionaries) as CSV to stdout, filtering only allowed fields."""
-    writer = csv.DictWriter(sys.stdout, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL)
-    writer.writeheader()
-    if rows and VERBOSE:
-        print("DEBUG: first row keys:", list(rows[0].keys()), file=sys.stderr)
-    for row in rows:
-        # Remove all keys not in fieldnames
-        filtered_row = {k: row.get(k, "") for k in fieldnames}
-        # Remove extra keys if any exist
-        for k in list(row.keys()):
-            if k not in fieldnames:
-                del row[k]
-        writer.writerow(filtered_row)
+# Value of the tags table "type" column for each osmdiff object class
+_TYPE_STR = {osmdiff.Node: "node", osmdiff.Way: "way", osmdiff.Relation: "relation"}
+
+
+@functools.lru_cache(maxsize=8192)
+def to_epoch_millis(ts):
+    """Convert an OSM timestamp to epoch milliseconds, or None if it can't be parsed."""
+    if ts is None:
+        return None
+    if isinstance(ts, (int, float)):
+        # Assume already ms
+        return int(ts)
+    # ISO8601 fast path (e.g. '2025-03-03T11:55:24Z'), sliced by hand to skip
+    # strptime; the datetime constructor still rejects out-of-range fields
+    if (len(ts) == 20 and ts[4] == "-" and ts[7] == "-" and ts[10] == "T"
+            and ts[13] == ":" and ts[16] == ":" and ts[19] == "Z"):
+        try:
+            dt = datetime(
+                int(ts[0:4]),
+                int(ts[5:7]),
+                int(ts[8:10]),
+                int(ts[11:13]),
+                int(ts[14:16]),
+                int(ts[17:19]),
+                tzinfo=timezone.utc,
+            )
+            return int(dt.timestamp()) * 1000
+        except ValueError:
+            pass
+    # Try as float seconds
+    try:
+        return int(float(ts) * 1000)
+    except Exception:
+        return None
+
+
+# Row layouts of the five tables. Rows are built as plain tuples in this order;
+# the namedtuple types name the columns for the CSV header and debug output.
+NodeRow = collections.namedtuple(
+    "NodeRow",
+    ["epochMillis", "id", "version", "changeset", "username", "uid", "lat", "lon"],
+)
+WayRow = collections.namedtuple(
+    "WayRow",
+    ["epochMillis", "id", "version", "changeset", "username", "uid", "geometry"],
+)
+RelationRow = collections.namedtuple(
+    "RelationRow",
+    ["epochMillis", "id", "version", "changeset", "username", "uid", "geometry"],
+)
+MemberRow = collections.namedtuple("MemberRow", ["relationId", "memberId", "memberRole", "memberType"])
+TagRow = collections.namedtuple("TagRow", ["epochMillis", "type", "id", "key", "value"])
+
+
+def make_writer(row_type):
+    """Return a function writing rows (tuples laid out like row_type) as CSV to stdout."""
+    # The field names never need quoting, so the header line is built once up front
+    header = ",".join(row_type._fields) + "\r\n"
+
+    def write_rows(rows):
+        out = sys.stdout
+        if rows and VERBOSE:
+            print("DEBUG: first row:", row_type._make(rows[0]), file=sys.stderr)
+        # Format into memory and hand stdout a few large strings, not one per row
+        buf = io.StringIO()
+        buf.write(header)
+        writer = csv.writer(buf, quoting=csv.QUOTE_MINIMAL)
+        for i in range(0, len(rows), CSV_CHUNK_ROWS):
+            writer.writerows(rows[i:i + CSV_CHUNK_ROWS])
+            if buf.tell() >= CSV_FLUSH_SIZE:
+                out.write(buf.getvalue())
+                buf.seek(0)
+                buf.truncate()
+        out.write(buf.getvalue())
+
+    return write_rows
+
+
+write_nodes = make_writer(NodeRow)
+write_ways = make_writer(WayRow)
+write_relations = make_writer(RelationRow)
+write_members = make_writer(MemberRow)
+write_tags = make_writer(TagRow)
+
+
+def _build_rows(objects):
+    """Transform osmdiff objects into CSV row tuples for the enabled tables.
+
+    Returns (nodes, ways, relations, members, tags, changesets): five lists of
+    row tuples, empty for disabled tables, and the set of changeset id strings
+    seen.
+    """
+    nodes_rows = []
+    ways_rows = []
+    relations_rows = []
+    members_rows = []
+    tags_rows = []
+    changesets = set()
+    # Only build rows for the tables that will be written
+    want_nodes, want_ways, want_relations = NODES, WAYS, RELATIONS
+    want_members, want_tags = MEMBERS, TAGS
+    # Classify every created object in a single pass
+    for o in objects:
+        t = type(o)
+        attribs = o.attribs
+        get = attribs.get
+        ts_ms = to_epoch_millis(get("timestamp"))
+        id_ = get("id")
+        # Elements of one changeset share these values; intern them so the
+        # rows reference one string each instead of a copy per element
+        changeset = sys.intern(get("changeset") or "")
+        user = sys.intern(get("user") or "")
+        uid = sys.intern(get("uid") or "")
+        changesets.add(changeset)
+        if t is osmdiff.Node:
+            if want_nodes:
+                nodes_rows.append((
+                    ts_ms,
+                    id_,
+                    get("version"),
+                    changeset,
+                    user,
+                    uid,
+                    get("lat"),
+                    get("lon"),
+                ))
+        elif t is osmdiff.Way:
+            if want_ways:
+                ways_rows.append((
+                    ts_ms,
+                    id_,
+                    get("version"),
+                    changeset,
+                    user,
+                    uid,
+                    get("geometry"),
+                ))
+        elif t is osmdiff.Relation:
+            if want_relations:
+                relations_rows.append((
+                    ts_ms,
+                    id_,
+                    get("version"),
+                    changeset,
+                    user,
+                    uid,
+                    get("geometry"),
+                ))
+            # Members and tags may need similar filtering/flattening if used
+            if want_members:
+                for m in o.members:
+                    m_get = m.attribs.get
+                    members_rows.append((id_, m_get("ref"), m_get("role"), m_get("type")))
+
+        # extract all tags; type is "node", "way", or "relation"
+        if want_tags:
+            osm_type = _TYPE_STR.get(t, "relation")
+            for k, v in o.tags.items():
+                tags_rows.append((ts_ms, osm_type, id_, k, v))
+    return nodes_rows, ways_rows, relations_rows, members_rows, tags_rows, changesets
 
 
 def main():
+    # Collect CSV output in a large buffer so it reaches the pipe in few writes
+    sys.stdout = io.TextIOWrapper(
+        io.BufferedWriter(sys.stdout.buffer, buffer_size=1 << 20),
+        encoding="utf-8",
+        line_buffering=False,
+        write_through=False,
+    )
     max_changeset_id = 0
     if len(sys.argv) != 3:
         print("Usage: consumer.py <sequence_number> <etag_output_path>")
@@ -52,147 +211,28 @@ def main():
     adiff.retrieve()
 
     try:
-        # Transform osmdiff objects to expected CSV dicts
-        from datetime import datetime, timezone
-        def to_epoch_millis(ts):
-            if ts is None:
-                return None
-            if isinstance(ts, (int, float)):
-                # Assume already ms
-                return int(ts)
-            # Try ISO8601 parsing (e.g. '2025-03-03T11:55:24Z')
-            try:
-                dt = datetime.strptime(ts, "%Y-%m-%dT%H:%M:%SZ")
-                return int(dt.replace(tzinfo=timezone.utc).timestamp() * 1000)
-            except Exception:
-                pass
-            # Try as float seconds
-            try:
-                return int(float(ts) * 1000)
-            except Exception:
-                return None
-
-        nodes_rows = []
-        for o in adiff.create:
-            max_changeset_id = max(max_changeset_id, int(o.attribs.get("changeset", 0)))
-            if isinstance(o, osmdiff.Node):
-                row = {
-                    "epochMillis": to_epoch_millis(o.attribs.get("timestamp")),
-                    "id": o.attribs.get("id"),
-                    "version": o.attribs.get("version"),
-                    "changeset": o.attribs.get("changeset"),
-                    "username": o.attribs.get("user"),
-                    "uid": o.attribs.get("uid"),
-                    "lat": o.attribs.get("lat"),
-                    "lon": o.attribs.get("lon"),
-                }
-                nodes_rows.append(row)
-
-        ways_rows = []
-        for o in adiff.create:
-            max_changeset_id = max(max_changeset_id, int(o.attribs.get("changeset", 0)))
-            if isinstance(o, osmdiff.Way):
-                row = {
-                    "epochMillis": to_epoch_millis(o.attribs.get("timestamp")),
-                    "id": o.attribs.get("id"),
-                    "version": o.attribs.get("version"),
-                    "changeset": o.attribs.get("changeset"),
-                    "username": o.attribs.get("user"),
-                    "uid": o.attribs.get("uid"),
-                    "geometry": o.attribs.get("geometry"),
-                }
-                ways_rows.append(row)
-
-        relations_rows = []
-        for o in adiff.create:
-            if isinstance(o, osmdiff.Relation):
-                row = {
-                    "epochMillis": to_epoch_millis(o.attribs.get("timestamp")),
-                    "id": o.attribs.get("id"),
-                    "version": o.attribs.get("version"),
-                    "changeset": o.attribs.get("changeset"),
-                    "username": o.attribs.get("user"),
-                    "uid": o.attribs.get("uid"),
-                    "geometry": o.attribs.get("geometry"),
-                }
-                max_changeset_id = max(max_changeset_id, int(o.attribs.get("changeset", 0)))
-                relations_rows.append(row)
-
-        # Members and tags may need similar filtering/flattening if used
-        members_rows = []
-        for o in adiff.create:
-            if isinstance(o, osmdiff.Relation):
-                for m in getattr(o, 'members', []):
-                    members_rows.append({
-                        "relationId": o.attribs.get("id"),
-                        "memberId": m.attribs.get("ref"),
-                        "memberRole": m.attribs.get("role"),
-                        "memberType": m.attribs.get("type"),
-                    })
-        
-        tags_rows = []
-        for o in adiff.create:
-            # extract all tags
-            for k, v in o.attribs.items():
-                if k == "id":
-                    continue
-                osm_type = "node" if isinstance(o, osmdiff.Node) else "way" if isinstance(o, osmdiff.Way) else "relation"
-                tags_rows.append({
-                    "epochMillis": to_epoch_millis(o.attribs.get("timestamp")),
-                    # type is "node", "way", or "relation"
-                    "type": osm_type,
-                    "id": o.attribs.get("id"),
-                    "key": k,
-                    "value": v,
-                })  
+        # Transform osmdiff objects to CSV row tuples
+        nodes_rows, ways_rows, relations_rows, members_rows, tags_rows, changesets = _build_rows(adiff.create)
+        # Interned changeset strings repeat heavily, so parse each distinct one once
+        max_changeset_id = max((int(c) for c in changesets if c), default=0)
 
         # Write nodes CSV with the specified columns.
         if VERBOSE:
             print("\n--- nodes.csv ---")
         if NODES:
-            node_fields = [
-                "epochMillis",
-                "id",
-                "version",
-                "changeset",
-                "username",
-                "uid",
-                "lat",
-                "lon",
-            ]
-            write_csv_stdout(nodes_rows, node_fields)
+            write_nodes(nodes_rows)
 
         if WAYS:
-            way_fields = [
-                "epochMillis",
-                "id",
-                "version",
-                "changeset",
-                "username",
-                "uid",
-                "geometry",
-            ]
-            write_csv_stdout(ways_rows, way_fields)
+            write_ways(ways_rows)
 
         if RELATIONS:
-            relation_fields = [
-                "epochMillis",
-                "id",
-                "version",
-                "changeset",
-                "username",
-                "uid",
-                "geometry",
-            ]
-            write_csv_stdout(relations_rows, relation_fields)
+            write_relations(relations_rows)
 
         if MEMBERS:
-            members_fields = ["relationId", "memberId", "memberRole", "memberType"]
-            write_csv_stdout(members_rows, members_fields)
+            write_members(members_rows)
 
         if TAGS:
-            tags_fields = ["epochMillis", "type", "id", "key", "value"]
-            write_csv_stdout(tags_rows, tags_fields)
+            write_tags(tags_rows)
 
         if VERBOSE:
             print("Processing complete")
@@ -212,8 +252,14 @@ def main():
 
     if VERBOSE:
         print(f"max changeset id: {max_changeset_id}")
-    with open(etag_output_path, "w") as fh:
-        fh.write(str(max_changeset_id))
+    sys.stdout.flush()
+    # Write the etag with a single write and fsync it so it survives a crash
+    fd = os.open(etag_output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, str(max_changeset_id).encode())
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 if __name__ == "__main__":